@@ -42,7 +42,7 @@ async def run_server(application, bind, port, ProtocolClass):
         reuse_port=True,
         start_serving=True,
     )
-    log.info(f"Listening on {bind}:{port} ...")
+    log.info("Listening on %s:%s ...", bind, port)
 
     return server
 
@@ -1,8 +1,11 @@
 import asyncio
 import click
 import logging
-import secrets
+import os
+import sys
 
+from collections import defaultdict
+from itertools import chain
 from openttd_helpers import click_helper
 from openttd_protocol.protocol.coordinator import (
     ConnectionType,
@@ -17,6 +20,7 @@ from prometheus_client import (
 
 from .helpers.client import Client
 from .helpers.invite_code import (
+    INVITE_CODE_LENGTH,
     generate_invite_code,
     generate_invite_code_secret,
     validate_invite_code_secret,
@@ -44,6 +48,37 @@ BLACKLISTED_SERVER_NAMES = [
 class Application:
     NAME = "coordinator"
 
+    # Every packet handler goes through these attributes; slots keep that
+    # access cheap. Remember to list new attributes here.
+    __slots__ = (
+        "stats_coordinator_tcp_register",
+        "stats_coordinator_tcp_update",
+        "stats_coordinator_tcp_listing",
+        "stats_coordinator_tcp_listing_bytes",
+        "stats_coordinator_tcp_listing_newgrf_bytes",
+        "stats_coordinator_tcp_connect",
+        "stats_coordinator_tcp_connect_result",
+        "stats_coordinator_tcp_connect_bytes",
+        "stats_coordinator_tcp_connected",
+        "stats_coordinator_tcp_connect_failed",
+        "stats_coordinator_tcp_stun_result",
+        "stats_coordinator_tcp_verify_result",
+        "stats_coordinator_tcp_verify_result_direct",
+        "stats_coordinator_connections",
+        "stats_coordinator_servers",
+        "_shared_secret",
+        "database",
+        "socks_proxy",
+        "_servers",
+        "_tokens",
+        "_newgrf_lookup_table",
+        "_newgrf_by_key",
+        "_newgrf_lookup_head",
+        "_servers_by_version",
+        "_reachable_servers",
+        "turn_servers",
+    )
+
     def __init__(self, database):
         if not _shared_secret:
             raise Exception("Please set --shared-secret for this application")
@@ -94,6 +129,10 @@ class Application:
         self._servers = {}
         self._tokens = {}
         self._newgrf_lookup_table = {}
+        self._newgrf_by_key = {}
+        self._newgrf_lookup_head = 0
+        self._servers_by_version = defaultdict(set)
+        self._reachable_servers = set()
         self.turn_servers = []
 
         self.database.application = self
@@ -105,7 +144,7 @@ class Application:
         log.info("Shutting down Game Coordinator ...")
 
         for server in self._servers.values():
-            if isinstance(server, ServerExternal):
+            if server.is_external:
                 continue
             server._source.protocol.transport.close()
 
@@ -115,20 +154,70 @@ class Application:
     def disconnect(self, source):
         self.stats_coordinator_connections.dec()
 
-        if hasattr(source, "server"):
-            asyncio.create_task(self.remove_server(source.server.server_id))
+        server = getattr(source, "server", None)
+        if server is None:
+            return
+
+        server = self._pop_server(server.server_id)
+        if server is not None:
+            asyncio.create_task(self._disconnect_server(server))
 
     def delete_token(self, token):
-        self._tokens[token].delete_client_token()
-        del self._tokens[token]
+        token = self._tokens.pop(token, None)
+        if token is not None:
+            token.delete_client_token()
+
+    def _index_server(self, server, old_openttd_version):
+        self._discard_from_index(server, old_openttd_version)
+
+        # Late updates can arrive for a server that was already replaced or
+        # removed; those should never end up in the listing again.
+        if self._servers.get(server.server_id) is not server:
+            return
+        # Servers that are not reachable shouldn't be listed.
+        if server.connection_type == ConnectionType.CONNECTION_TYPE_ISOLATED:
+            return
+        # Server is announced but hasn't finished registration.
+        if not server.info:
+            return
+
+        self._servers_by_version[server.info["openttd_version"]].add(server)
+        self._reachable_servers.add(server)
+
+    def _unindex_server(self, server):
+        self._discard_from_index(server, server.info.get("openttd_version"))
+
+    def _discard_from_index(self, server, openttd_version):
+        servers = self._servers_by_version.get(openttd_version)
+        if servers is not None:
+            servers.discard(server)
+            if not servers:
+                del self._servers_by_version[openttd_version]
+
+        self._reachable_servers.discard(server)
+
+    def _set_server(self, server_id, server):
+        # Whatever we replace should no longer be listed.
+        existing = self._servers.get(server_id)
+        if existing is not None:
+            self._unindex_server(existing)
+
+        self._servers[server_id] = server
+        return server
+
+    def _pop_server(self, server_id):
+        server = self._servers.pop(server_id, None)
+        if server is not None:
+            self._unindex_server(server)
+        return server
 
     def _remove_broken_server(self, server_id, error_no, error_detail):
         broken_server = self._servers[server_id]
-        if isinstance(broken_server, ServerExternal):
+        if broken_server.is_external:
             return
 
         asyncio.create_task(broken_server.send_error_and_close(error_no, error_detail))
-        del self._servers[server_id]
+        self._pop_server(server_id)
 
     async def add_turn_server(self, connection_string):
         if connection_string not in self.turn_servers:
@@ -141,17 +230,31 @@ class Application:
     async def newgrf_added(self, index, newgrf):
         self._newgrf_lookup_table[index] = newgrf
 
+        # A NewGRF can briefly have two indices: when its key expires,
+        # another instance can assign a new index before we see the expiry.
+        # Keep them in the order they were added, so the expiry removes the
+        # old one. Re-adding an index (to update the name) keeps its place.
+        indices = self._newgrf_by_key.setdefault((newgrf["grfid"], newgrf["md5sum"]), [])
+        if index not in indices:
+            indices.append(index)
+
+        if index > self._newgrf_lookup_head:
+            self._newgrf_lookup_head = index
+
     async def remove_newgrf_from_table(self, grfid, md5sum):
-        for index, newgrf in self._newgrf_lookup_table.items():
-            if newgrf["grfid"] == grfid and newgrf["md5sum"] == md5sum:
-                del self._newgrf_lookup_table[index]
-                return
+        indices = self._newgrf_by_key.get((grfid, md5sum))
+        if not indices:
+            return
 
-    async def update_external_server(self, server_id, info):
-        if server_id not in self._servers:
-            self._servers[server_id] = ServerExternal(self, server_id)
+        self._newgrf_lookup_table.pop(indices.pop(0), None)
+        if not indices:
+            del self._newgrf_by_key[(grfid, md5sum)]
 
-        if not isinstance(self._servers[server_id], ServerExternal):
+    async def update_external_server(self, server_id, info):
+        server = self._servers.get(server_id)
+        if server is None:
+            server = self._set_server(server_id, ServerExternal(self, server_id))
+        elif not server.is_external:
             # Two servers could announce themselves with the same server-id.
             # Best way to deal with the situation is to assume the new instance
             # is in good contact with the server, and for us to drop our
@@ -160,15 +263,15 @@ class Application:
             self._remove_broken_server(
                 server_id, NetworkCoordinatorErrorType.NETWORK_COORDINATOR_ERROR_REUSE_OF_INVITE_CODE, server_id
             )
-            self._servers[server_id] = ServerExternal(self, server_id)
+            server = self._set_server(server_id, ServerExternal(self, server_id))
 
-        await self._servers[server_id].update(info)
+        await server.update(info)
 
     async def update_newgrf_external_server(self, server_id, newgrfs_indexed):
-        if server_id not in self._servers:
-            self._servers[server_id] = ServerExternal(self, server_id)
-
-        if not isinstance(self._servers[server_id], ServerExternal):
+        server = self._servers.get(server_id)
+        if server is None:
+            server = self._set_server(server_id, ServerExternal(self, server_id))
+        elif not server.is_external:
             # Two servers could announce themselves with the same server-id.
             # Best way to deal with the situation is to assume the new instance
             # is in good contact with the server, and for us to drop our
@@ -177,67 +280,67 @@ class Application:
             self._remove_broken_server(
                 server_id, NetworkCoordinatorErrorType.NETWORK_COORDINATOR_ERROR_REUSE_OF_INVITE_CODE, server_id
             )
-            self._servers[server_id] = ServerExternal(self, server_id)
+            server = self._set_server(server_id, ServerExternal(self, server_id))
 
-        await self._servers[server_id].update_newgrf(newgrfs_indexed)
+        await server.update_newgrf(newgrfs_indexed)
 
     async def update_external_direct_ip(self, server_id, type, ip, port):
-        if server_id not in self._servers:
-            self._servers[server_id] = ServerExternal(self, server_id)
-
-        if not isinstance(self._servers[server_id], ServerExternal):
+        server = self._servers.get(server_id)
+        if server is None:
+            server = self._set_server(server_id, ServerExternal(self, server_id))
+        elif not server.is_external:
             log.error("Internal error: update_external_direct_ip() called on a server managed by us")
             return
 
-        await self._servers[server_id].update_direct_ip(type, ip, port)
+        await server.update_direct_ip(type, ip, port)
 
     async def send_server_stun_request(self, server_id, protocol_version, token):
-        if server_id not in self._servers:
+        server = self._servers.get(server_id)
+        if server is None:
             return
 
-        if isinstance(self._servers[server_id], ServerExternal):
+        if server.is_external:
             log.error("Internal error: server_stun_request() called on a server NOT managed by us")
             return
 
-        await self._servers[server_id].send_stun_request(protocol_version, token)
+        await server.send_stun_request(protocol_version, token)
 
     async def send_server_stun_connect(
         self, server_id, protocol_version, token, tracking_number, interface_number, peer_ip, peer_port
     ):
-        if server_id not in self._servers:
+        server = self._servers.get(server_id)
+        if server is None:
             return
 
-        if isinstance(self._servers[server_id], ServerExternal):
+        if server.is_external:
             log.error("Internal error: server_stun_connect() called on a server NOT managed by us")
             return
 
-        await self._servers[server_id].send_stun_connect(
-            protocol_version, token, tracking_number, interface_number, peer_ip, peer_port
-        )
+        await server.send_stun_connect(protocol_version, token, tracking_number, interface_number, peer_ip, peer_port)
 
     async def send_server_turn_connect(
         self, server_id, protocol_version, token, tracking_number, ticket, connection_string
     ):
-        if server_id not in self._servers:
+        server = self._servers.get(server_id)
+        if server is None:
             return
 
-        if isinstance(self._servers[server_id], ServerExternal):
+        if server.is_external:
             log.error("Internal error: server_turn_connect() called on a server NOT managed by us")
             return
 
-        await self._servers[server_id].send_turn_connect(
-            protocol_version, token, tracking_number, ticket, connection_string
-        )
+        await server.send_turn_connect(protocol_version, token, tracking_number, ticket, connection_string)
 
     async def send_server_connect_failed(self, server_id, protocol_version, token):
-        if server_id not in self._servers:
+        server = self._servers.get(server_id)
+        if server is None:
             return
 
-        if isinstance(self._servers[server_id], ServerExternal):
+        if server.is_external:
             log.error("Internal error: server_connect_failed() called on a server NOT managed by us")
             return
 
-        await self._servers[server_id].send_connect_failed(protocol_version, token)
+        await server.send_connect_failed(protocol_version, token)
 
     async def stun_result(self, token, interface_number, peer_type, peer_ip, peer_port):
         prefix = token[0]
@@ -247,22 +350,22 @@ class Application:
 
         await token.stun_result(prefix, interface_number, peer_type, peer_ip, peer_port)
 
-    async def remove_server(self, server_id):
-        if server_id not in self._servers:
-            return
-
+    async def _disconnect_server(self, server):
         # Check if there are any pending connections to this server.
-        abort_tokens = []
-        for token in self._tokens.values():
-            if token._server.server_id == server_id:
-                abort_tokens.append(token)
+        abort_tokens = [token for token in self._tokens.values() if token._server.server_id == server.server_id]
 
         # Abort all of those pending connections.
         for token in abort_tokens:
             await token.abort_attempt("server")
 
-        await self._servers[server_id].disconnect()
-        del self._servers[server_id]
+        await server.disconnect()
+
+    async def remove_server(self, server_id):
+        server = self._pop_server(server_id)
+        if server is None:
+            return
+
+        await self._disconnect_server(server)
 
     async def gc_connect_failed(self, token, tracking_number):
         token = self._tokens.get(token)
@@ -283,9 +386,12 @@ class Application:
     async def receive_PACKET_COORDINATOR_SERVER_REGISTER(
         self, source, protocol_version, game_type, server_port, invite_code, invite_code_secret
     ):
+        servers = self._servers
+
         if (
             invite_code
             and invite_code_secret
+            and len(invite_code) == INVITE_CODE_LENGTH
             and invite_code[0] == "+"
             and validate_invite_code_secret(self._shared_secret, invite_code, invite_code_secret)
         ):
@@ -296,7 +402,7 @@ class Application:
             stats_invite_code = "new"
             while True:
                 server_id = generate_invite_code(self.database.get_server_id())
-                if server_id not in self._servers:
+                if server_id not in servers:
                     break
 
             invite_code_secret = generate_invite_code_secret(self._shared_secret, server_id)
@@ -307,34 +413,33 @@ class Application:
 
         old_server_id = source.server.server_id if hasattr(source, "server") else None
 
-        source.server = Server(self, server_id, game_type, source, protocol_version, server_port, invite_code_secret)
+        server = Server(self, server_id, game_type, source, protocol_version, server_port, invite_code_secret)
+        source.server = server
 
-        if source.server.server_id == old_server_id:
+        if server_id == old_server_id:
             # If the old server-id is the same, it means this server was
             # already registered via this connection, and the user is most
             # likely changing something like "game-type".
             pass
-        elif source.server.server_id in self._servers:
+        elif server_id in servers:
             # We replace a server already known; possibly two servers are using
             # the same invite-code. There is not much we can do about this,
             # other than disconnect the old, and hope the server-owner notices
             # that they are constantly battling for the same invite-code.
             self._remove_broken_server(
-                source.server.server_id,
+                server_id,
                 NetworkCoordinatorErrorType.NETWORK_COORDINATOR_ERROR_REUSE_OF_INVITE_CODE,
-                source.server.server_id,
+                server_id,
             )
 
-        self._servers[source.server.server_id] = source.server
+        self._set_server(server_id, server)
 
-        # Find an unused token.
-        while True:
-            token = secrets.token_hex(16)
-            if token not in self._tokens:
-                break
+        # 128 bits of randomness; a collision with a token in use is not a
+        # realistic concern.
+        token = os.urandom(16).hex()
 
         # Create a token to connect server and client.
-        token = TokenVerify(self, source, protocol_version, token, source.server)
+        token = TokenVerify(self, source, protocol_version, token, server)
         self._tokens[token.token] = token
 
         await token.connect()
@@ -344,6 +449,8 @@ class Application:
     ):
         self.stats_coordinator_tcp_update.inc()
 
+        server = source.server
+
         # If the server-name is blacklisted, change the game-type to invite-only.
         # This way, everyone that knows about the server can still use it, but
         # it will no longer be publicly listed.
@@ -352,47 +459,44 @@ class Application:
         server_name = info["name"].lower()
         for blacklisted_server_name in BLACKLISTED_SERVER_NAMES:
             if blacklisted_server_name in server_name:
-                source.server.game_type = ServerGameType.SERVER_GAME_TYPE_INVITE_ONLY
+                server.game_type = ServerGameType.SERVER_GAME_TYPE_INVITE_ONLY
 
-        await source.server.update_newgrf(newgrf_serialization_type, newgrfs)
-        await source.server.update(info)
+        await server.update_newgrf(newgrf_serialization_type, newgrfs)
+        await server.update(info)
 
     async def receive_PACKET_COORDINATOR_CLIENT_LISTING(
         self, source, protocol_version, game_info_version, openttd_version, newgrf_lookup_table_cursor
     ):
+        openttd_version = sys.intern(openttd_version)
         self.stats_coordinator_tcp_listing.labels(openttd_version=openttd_version).inc()
 
-        if protocol_version >= 4 and self._newgrf_lookup_table:
-            length = await source.protocol.send_PACKET_COORDINATOR_GC_NEWGRF_LOOKUP(
-                protocol_version, newgrf_lookup_table_cursor, self._newgrf_lookup_table
+        protocol = source.protocol
+        newgrf_lookup_table = self._newgrf_lookup_table
+
+        # Indices only increase, so a client whose cursor is at the highest
+        # index we know of has nothing new to learn.
+        if protocol_version >= 4 and newgrf_lookup_table and newgrf_lookup_table_cursor < self._newgrf_lookup_head:
+            length = await protocol.send_PACKET_COORDINATOR_GC_NEWGRF_LOOKUP(
+                protocol_version, newgrf_lookup_table_cursor, newgrf_lookup_table
             )
             self.stats_coordinator_tcp_listing_newgrf_bytes.observe(length)
 
-        # Ensure servers matching "openttd_version" are at the top.
-        servers_match = []
-        servers_other = []
-        for server in self._servers.values():
-            # Servers that are not reachable shouldn't be listed.
-            if server.connection_type == ConnectionType.CONNECTION_TYPE_ISOLATED:
-                continue
-            # Server is announced but hasn't finished registration.
-            if not server.info:
-                continue
-
-            if server.info["openttd_version"] == openttd_version:
-                servers_match.append(server)
-            else:
-                servers_other.append(server)
+        # Ensure servers matching "openttd_version" are at the top. Sending
+        # can yield to the event loop, which can change the live bucket, so
+        # iterate over a snapshot of it.
+        servers_match = tuple(self._servers_by_version.get(openttd_version, ()))
+        servers_other = self._reachable_servers.difference(servers_match)
 
-        length = await source.protocol.send_PACKET_COORDINATOR_GC_LISTING(
-            protocol_version, game_info_version, servers_match + servers_other, self._newgrf_lookup_table
+        length = await protocol.send_PACKET_COORDINATOR_GC_LISTING(
+            protocol_version, game_info_version, chain(servers_match, servers_other), newgrf_lookup_table
         )
         self.stats_coordinator_tcp_listing_bytes.labels(openttd_version=openttd_version).observe(length)
 
     async def receive_PACKET_COORDINATOR_CLIENT_CONNECT(self, source, protocol_version, invite_code):
         self.stats_coordinator_tcp_connect.inc()
 
-        if not invite_code or invite_code[0] != "+" or invite_code not in self._servers:
+        server = self._servers.get(invite_code) if invite_code and invite_code[0] == "+" else None
+        if server is None:
             self.stats_coordinator_tcp_connect_result.labels(result="invalid-invite-code").inc()
 
             await source.protocol.send_PACKET_COORDINATOR_GC_ERROR(
@@ -404,21 +508,20 @@ class Application:
         if not hasattr(source, "client"):
             source.client = Client()
 
-        # Find an unused token.
-        while True:
-            token = secrets.token_hex(16)
-            if token not in self._tokens:
-                break
+        # 128 bits of randomness; a collision with a token in use is not a
+        # realistic concern.
+        token = os.urandom(16).hex()
 
         # A client is always connected to a single GC instance. So on that
         # instance we track if the client tries to connect to the same server
         # twice. If so, we abort the previous connection and create a new one.
-        if invite_code in source.client.connections:
-            await source.client.connections[invite_code].abort_attempt("client")
+        connections = source.client.connections
+        if invite_code in connections:
+            await connections[invite_code].abort_attempt("client")
 
         # Create a token to connect server and client.
-        token = TokenConnect(self, source, protocol_version, token, self._servers[invite_code])
-        source.client.connections[invite_code] = token
+        token = TokenConnect(self, source, protocol_version, token, server)
+        connections[invite_code] = token
         self._tokens[token.token] = token
 
         # Inform client of token value, and start the connection attempt(s).
@@ -431,16 +534,19 @@ class Application:
     async def receive_PACKET_COORDINATOR_SERCLI_CONNECT_FAILED(self, source, protocol_version, token, tracking_number):
         self.stats_coordinator_tcp_connect_failed.inc()
 
-        if token[1:] not in self._tokens:
-            if token[0] == "S":
+        prefix = token[0]
+        token_value = token[1:]
+        token = self._tokens.get(token_value)
+        if token is None:
+            if prefix == "S":
                 # The server tells us information about a token we do not track.
                 # So broadcast it to the other instances, as they might want to
                 # know.
-                await self.database.gc_connect_failed(token[1:], tracking_number)
+                await self.database.gc_connect_failed(token_value, tracking_number)
             return
 
         # Client or server noticed the connection attempt failed.
-        await self.gc_connect_failed(token[1:], tracking_number)
+        await token.connect_failed(tracking_number)
 
     async def receive_PACKET_COORDINATOR_CLIENT_CONNECTED(self, source, protocol_version, token):
         token = self._tokens.get(token[1:])
@@ -461,15 +567,17 @@ class Application:
         self.stats_coordinator_tcp_stun_result.inc()
 
         prefix = token[0]
-        if token[1:] not in self._tokens:
-            if token[0] == "S":
+        token_value = token[1:]
+        token = self._tokens.get(token_value)
+        if token is None:
+            if prefix == "S":
                 # The server tells us information about a token we do not track.
                 # So broadcast it to the other instances, as they might want to
                 # know.
-                await self.database.gc_stun_result(prefix, token[1:], interface_number, result)
+                await self.database.gc_stun_result(prefix, token_value, interface_number, result)
             return
 
-        await self.gc_stun_result(prefix, token[1:], interface_number, result)
+        await token.stun_result_concluded(prefix, interface_number, result)
 
 
 @click_helper.extend
@@ -5,6 +5,9 @@ import time
 # Make sure the length of this alphabet is always a prime number!
 HUMAN_ENCODE_CHARS = "abcdefghjkmnpqrstuvwxyzABCDEFGHJKMNQRSTUVWXYZ23456789"
 HUMAN_ENCODE_BASE = len(HUMAN_ENCODE_CHARS)
+# A 40 bit invite code with bit 39 set always encodes to 7 characters, plus
+# the leading "+". See generate_invite_code().
+INVITE_CODE_LENGTH = 8
 
 
 def human_encode(value):
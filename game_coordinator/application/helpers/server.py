@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import sys
 
 from openttd_protocol.protocol.coordinator import (
     ConnectionType,
@@ -17,6 +18,9 @@ class ConnectAndCloseProtocol(asyncio.Protocol):
 
 
 class ServerExternal:
+    # Managed by another Game Coordinator instance.
+    is_external = True
+
     def __init__(self, application, server_id):
         self._application = application
         self.info = {}
@@ -33,10 +37,21 @@ class ServerExternal:
     async def disconnect(self):
         pass
 
+    def set_connection_type(self, connection_type):
+        self.connection_type = connection_type
+        self._application._index_server(self, self.info.get("openttd_version"))
+
     async def update(self, info):
+        old_openttd_version = self.info.get("openttd_version")
+
         self.game_type = ServerGameType(info["game_type"])
         self.connection_type = ConnectionType(info["connection_type"])
         self.info = info
+        # Only a handful of versions are in use at any time; interning them
+        # makes comparing against the version of a client listing cheap.
+        self.info["openttd_version"] = sys.intern(info["openttd_version"])
+
+        self._application._index_server(self, old_openttd_version)
 
     async def update_newgrf(self, newgrfs_indexed):
         self.newgrfs_indexed = newgrfs_indexed
@@ -55,7 +70,7 @@ class ServerExternal:
             ip = f"[{ip}]"
 
         self.direct_ips.add(f"{ip}:{port}")
-        self.connection_type = ConnectionType.CONNECTION_TYPE_DIRECT
+        self.set_connection_type(ConnectionType.CONNECTION_TYPE_DIRECT)
 
     async def send_stun_request(self, protocol_version, token):
         await self._application.database.send_server_stun_request(self.server_id, protocol_version, token)
@@ -75,6 +90,8 @@ class ServerExternal:
 
 
 class Server:
+    is_external = False
+
     def __init__(self, application, server_id, game_type, source, protocol_version, server_port, invite_code_secret):
         self._application = application
         self._source = source
@@ -151,11 +168,20 @@ class Server:
         self.newgrfs_indexed = newgrfs_indexed
         await self._application.database.update_newgrf(self.server_id, newgrfs_indexed)
 
+    def set_connection_type(self, connection_type):
+        self.connection_type = connection_type
+        self._application._index_server(self, self.info.get("openttd_version"))
+
     async def update(self, info):
+        old_openttd_version = self.info.get("openttd_version")
+
         self.info = info
+        self.info["openttd_version"] = sys.intern(info["openttd_version"])
         self.info["game_type"] = self.game_type.value
         self.info["connection_type"] = self.connection_type.value
 
+        self._application._index_server(self, old_openttd_version)
+
         await self._application.database.update_info(self.server_id, self.info)
 
     async def send_register_ack(self, protocol_version):
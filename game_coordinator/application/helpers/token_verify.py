@@ -77,7 +77,7 @@ class TokenVerify:
 
         # If we get a STUN result, at the very least the server is STUN capable.
         if self._server.connection_type == ConnectionType.CONNECTION_TYPE_ISOLATED:
-            self._server.connection_type = ConnectionType.CONNECTION_TYPE_STUN
+            self._server.set_connection_type(ConnectionType.CONNECTION_TYPE_STUN)
 
         task = asyncio.create_task(self._start_detection(interface_number, peer_ip))
         self._pending_detection_tasks.append(task)
@@ -98,7 +98,7 @@ class TokenVerify:
             await asyncio.wait_for(self._create_connection(server_ip, self._server.server_port), TIMEOUT_DIRECT_CONNECT)
 
             # We found a direct-ip to connect to. That is always the better one to use.
-            self._server.connection_type = ConnectionType.CONNECTION_TYPE_DIRECT
+            self._server.set_connection_type(ConnectionType.CONNECTION_TYPE_DIRECT)
 
             # Record the direct-ip in various of places.
             server_ip_str = f"[{server_ip}]" if isinstance(server_ip, ipaddress.IPv6Address) else str(server_ip)
@@ -146,7 +146,7 @@ class TokenVerify:
                 )
 
             if self._protocol_version >= 5 and self._server.connection_type == ConnectionType.CONNECTION_TYPE_ISOLATED:
-                self._server.connection_type = ConnectionType.CONNECTION_TYPE_TURN
+                self._server.set_connection_type(ConnectionType.CONNECTION_TYPE_TURN)
 
             await self._server.send_register_ack(self._protocol_version)
             self._application.stats_coordinator_tcp_verify_result.labels(
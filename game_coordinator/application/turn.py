@@ -51,7 +51,7 @@ class Application:
 
         # Wait till all relay sessions are terminated.
         while self._active_sources:
-            log.info(f"{len(self._active_sources) // 2} active connections left, waiting ...")
+            log.info("%d active connections left, waiting ...", len(self._active_sources) // 2)
             # Update every disconnect and every 30s since last disconnect how we are doing.
             self._shutdown.clear()
             try: